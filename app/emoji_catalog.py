@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2024-present toru173 and contributors
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted (subject to the limitations in the disclaimer
+# below) provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name of the copyright holder nor the names of the contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE. THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER
+# OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import annotations
+from typing import Optional, Union
+
+import logging
+
+import discord
+import regex
+
+# A single emoji as Discord accepts it for a reaction, including keycaps
+# (1️⃣), flags (🇺🇸, 🏴󠁧󠁢󠁳󠁣󠁴󠁿), skin tones (👍🏽) and ZWJ sequences (👨‍👩‍👧).
+# \p{Emoji} also matches plain digits, '#' and '*', and lone regional
+# indicators or skin tones, none of which Discord will react with.
+# Symbols that are text by default (like ©) are only emoji when followed
+# by U+FE0F, and only assigned code points have the Emoji properties
+_emoji_element = (
+    r"(?:\p{Emoji_Modifier_Base}\p{Emoji_Modifier}"
+    r"|(?!\p{Regional_Indicator}|\p{Emoji_Modifier})\p{Emoji_Presentation}\uFE0F?"
+    r"|(?![#*0-9]|\p{Emoji_Presentation})\p{Emoji}\uFE0F)"
+)
+unicode_emoji_phrase = (
+    r"(?:[#*0-9]\uFE0F?\u20E3"
+    r"|\p{Regional_Indicator}{2}"
+    r"|\U0001F3F4[\U000E0020-\U000E007E]+\U000E007F"
+    rf"|{_emoji_element}(?:\u200D{_emoji_element})*)"
+)
+
+# EmojiCatalog Class. Keeps a local record of which emojis
+# we can react with so we don't waste a round-trip to Discord
+# (and our reaction rate limit) on a reaction that will fail
+class EmojiCatalog:
+
+    _unicode_emoji_pattern = regex.compile(unicode_emoji_phrase)
+
+    # Custom guild emoji, either as a full Discord reference
+    # (<:name:id> or <a:name:id>) or as a :shortcode:
+    _custom_emoji_pattern = regex.compile(r"<a?:(\w+):(\d+)>|:(\w+):")
+
+    def __init__(self) -> None:
+        # Guild ID -> {emoji ID -> emoji}, kept current from guild events.
+        # Emoji names are case-sensitive and needn't be unique, so we
+        # only key on the ID
+        self._guild_emojis: dict[int, dict[int, Union[discord.Emoji, discord.PartialEmoji]]] = {}
+        # Emojis Discord has rejected. Unicode emojis are stored as str,
+        # custom emojis by their ID
+        self._rejected_emojis: set[Union[str, int]] = set()
+
+
+    def update_guild(self, guild: discord.Guild, emojis: Optional[tuple[discord.Emoji, ...]] = None) -> None:
+        if emojis is None:
+            emojis = guild.emojis
+
+        # Skip emojis we can't use, such as those limited to roles we don't have
+        self.set_guild_emojis(guild, [emoji for emoji in emojis if emoji.is_usable()])
+        logging.info(f"Cached {len(self._guild_emojis[guild.id])} custom emojis for {guild.name}")
+
+
+    def set_guild_emojis(self, guild: discord.abc.Snowflake, emojis: list[Union[discord.Emoji, discord.PartialEmoji]]) -> None:
+        # Replace a guild's custom emojis with ones we already know are usable,
+        # such as those a worker receives from the gateway
+        self._guild_emojis[guild.id] = {emoji.id: emoji for emoji in emojis}
+
+
+    def get_guild_emojis(self, guild: discord.abc.Snowflake) -> list[Union[discord.Emoji, discord.PartialEmoji]]:
+        return list(self._guild_emojis.get(guild.id, {}).values())
+
+
+    def remove_guild(self, guild: discord.abc.Snowflake) -> None:
+        self._guild_emojis.pop(guild.id, None)
+
+
+    def reject(self, emoji: Union[str, discord.Emoji, discord.PartialEmoji]) -> None:
+        if isinstance(emoji, str):
+            self._rejected_emojis.add(emoji)
+        else:
+            self._rejected_emojis.add(emoji.id)
+
+
+    def get_rejected_emojis(self) -> set[Union[str, int]]:
+        return set(self._rejected_emojis)
+
+
+    def add_rejected_emojis(self, emojis: set[Union[str, int]]) -> None:
+        # Merge in emojis another process has found Discord rejects
+        self._rejected_emojis.update(emojis)
+
+
+    def _get_custom_emoji(self, guild: Optional[discord.abc.Snowflake], name: Optional[str] = None, emoji_id: Optional[int] = None) -> Optional[discord.Emoji]:
+        emoji = None
+        if emoji_id is not None:
+            # Emoji IDs are unique, and we can react with an emoji from any
+            # guild we're in. This also works if the emoji has been renamed
+            for guild_emojis in self._guild_emojis.values():
+                emoji = guild_emojis.get(emoji_id)
+                if emoji is not None:
+                    break
+        elif guild is not None:
+            # A :shortcode: can only be matched by name in the current guild
+            emoji = discord.utils.get(self._guild_emojis.get(guild.id, {}).values(), name = name)
+
+        if emoji is None or emoji.id in self._rejected_emojis:
+            return None
+
+        return emoji
+
+
+    def find_reactions(self, text: str, guild: Optional[discord.abc.Snowflake]) -> list[Union[str, discord.Emoji]]:
+        # Returns every emoji in text that we expect Discord to accept as a
+        # reaction, in the order they appear, without duplicates
+        reactions = []
+
+        def add_reaction(emoji: Union[str, discord.Emoji]) -> None:
+            if emoji not in reactions:
+                reactions.append(emoji)
+
+        # Look for custom emojis first, then strip them out so their names
+        # and IDs aren't mistaken for Unicode emojis
+        for match in self._custom_emoji_pattern.finditer(text):
+            _, emoji_id, shortcode = match.groups()
+            if shortcode is not None:
+                emoji = self._get_custom_emoji(guild, name = shortcode)
+            else:
+                emoji = self._get_custom_emoji(guild, emoji_id = int(emoji_id))
+
+            if emoji is not None:
+                add_reaction(emoji)
+            else:
+                logging.info(f"Skipping reaction: {match.group(0)} is not a custom emoji we can use")
+
+        text = self._custom_emoji_pattern.sub('', text)
+
+        for emoji in self._unicode_emoji_pattern.findall(text):
+            if emoji in self._rejected_emojis:
+                logging.info(f"Skipping reaction: Discord has already rejected {emoji}")
+            else:
+                add_reaction(emoji)
+
+        return reactions
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2024-present toru173 and contributors
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted (subject to the limitations in the disclaimer
+# below) provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name of the copyright holder nor the names of the contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE. THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER
+# OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import annotations
+from typing import Optional, Union
+
+from abc import ABC, abstractmethod
+import json
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+
+# JobQueue Class. Carries normalised messages from the gateway
+# process (which talks to Discord) to the worker processes (which
+# talk to the Nomi API). Subclass this to use a different broker.
+# Methods may block, so call them from a thread rather than the
+# event loop
+class JobQueue(ABC):
+
+    @classmethod
+    def from_url(cls, url: str) -> JobQueue:
+        if type(url) is not str:
+            raise TypeError(f"Expected url to be a str, got a {type(url).__name__}")
+
+        parsed_url = urlparse(url)
+        if parsed_url.scheme == "sqlite":
+            # sqlite:///relative/path.db or sqlite:////absolute/path.db
+            return SQLiteJobQueue(path = parsed_url.path[1:] or parsed_url.netloc)
+
+        raise ValueError(f"Unsupported job queue: {url}")
+
+
+    @abstractmethod
+    def put(self, job: dict) -> None:
+        ...
+
+
+    @abstractmethod
+    def get(self) -> Optional[tuple[int, dict]]:
+        # Claim the next job, returning its ID and contents,
+        # or None if there is nothing waiting
+        ...
+
+
+    @abstractmethod
+    def ack(self, job_id: int) -> None:
+        # Mark a claimed job as done so it isn't handed out again
+        ...
+
+
+    # Emojis Discord has rejected as reactions, shared between workers so
+    # none of them retry an emoji another has already found to be invalid.
+    # Unicode emojis are stored as str, custom emojis by their ID
+
+    @abstractmethod
+    def reject_emoji(self, emoji: Union[str, int]) -> None:
+        ...
+
+
+    @abstractmethod
+    def get_rejected_emojis(self) -> set[Union[str, int]]:
+        ...
+
+
+# SQLiteJobQueue Class. A local queue shared between processes
+# on the same machine through a single SQLite database file
+class SQLiteJobQueue(JobQueue):
+
+    # Jobs claimed by a worker that hasn't acknowledged them
+    # within this many seconds are handed out again
+    _default_claim_timeout = 300
+
+    def __init__(self, *, path: str, claim_timeout: Optional[int] = None) -> None:
+        if type(path) is not str:
+            raise TypeError(f"Expected path to be a str, got a {type(path).__name__}")
+
+        # An empty path (or :memory:) gives every connection its own private
+        # database, so the gateway and workers would never see each other's jobs
+        if path in ("", ":memory:"):
+            raise ValueError("Expected path to be the path to a database file")
+
+        if claim_timeout is None:
+            claim_timeout = self._default_claim_timeout
+
+        if type(claim_timeout) is not int:
+            raise TypeError(f"Expected claim_timeout to be a int, got a {type(claim_timeout).__name__}")
+
+        self.path = path
+        self.claim_timeout = claim_timeout
+
+        # SQLite connections can't be shared between threads,
+        # so each thread that uses the queue gets its own
+        self._local = threading.local()
+
+        try:
+            self._connection.execute("PRAGMA journal_mode = WAL")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    body TEXT NOT NULL,
+                    claimed_at REAL
+                )
+            """)
+            # Values are JSON so str and int emojis survive the round trip
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS rejected_emojis (
+                    emoji TEXT PRIMARY KEY
+                )
+            """)
+        except sqlite3.Error as e:
+            raise ValueError(f"Unable to open job queue at {path}: {e}")
+
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # We manage transactions ourselves so claiming a job is atomic
+            connection = sqlite3.connect(self.path, timeout = 30, isolation_level = None)
+            self._local.connection = connection
+        return connection
+
+
+    def put(self, job: dict) -> None:
+        self._connection.execute("INSERT INTO jobs (body) VALUES (?)", (json.dumps(job),))
+
+
+    def get(self) -> Optional[tuple[int, dict]]:
+        now = time.time()
+        # BEGIN IMMEDIATE takes the write lock up front, so two
+        # workers can never claim the same job
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._connection.execute(
+                "SELECT id, body FROM jobs WHERE claimed_at IS NULL OR claimed_at < ? ORDER BY id LIMIT 1",
+                (now - self.claim_timeout,)
+            ).fetchone()
+
+            if row is not None:
+                self._connection.execute("UPDATE jobs SET claimed_at = ? WHERE id = ?", (now, row[0]))
+
+            self._connection.execute("COMMIT")
+        except:
+            self._connection.execute("ROLLBACK")
+            raise
+
+        if row is None:
+            return None
+
+        job_id, body = row
+        return job_id, json.loads(body)
+
+
+    def ack(self, job_id: int) -> None:
+        self._connection.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+
+    def reject_emoji(self, emoji: Union[str, int]) -> None:
+        self._connection.execute("INSERT OR IGNORE INTO rejected_emojis (emoji) VALUES (?)", (json.dumps(emoji),))
+
+
+    def get_rejected_emojis(self) -> set[Union[str, int]]:
+        rows = self._connection.execute("SELECT emoji FROM rejected_emojis").fetchall()
+        return {json.loads(emoji) for emoji, in rows}
@@ -40,6 +40,7 @@ import threading
 import discord
 from nomi import Session, Nomi
 from nomi_bot import NomiBot
+from job_queue import JobQueue
 
 # Utility Functions
 def strip_outer_quotation_marks(quoted_string: str) -> str:
@@ -73,7 +74,9 @@ def get_env_vars() -> dict:
                             "CHANNEL_MESSAGE_PREFIX",
                             "DM_MESSAGE_PREFIX",
                             "REACT_TRIGGER_PHRASE",
-                            "RENDER_EXTERNAL_URL"
+                            "RENDER_EXTERNAL_URL",
+                            "NOMI_MODE",
+                            "JOB_QUEUE_URL"
                     ]
     env = {}
     for var in REQUIRED_ENV_VARS:
@@ -182,6 +185,25 @@ def main() -> None:
         os.sys.stderr.write("NOMI_ID was not found in the environment variables\n")
         exit(1)
 
+    # 'standalone' does everything in this process. 'gateway' reads messages from
+    # Discord and queues them, and as many 'worker' processes as needed take
+    # them from the queue, send them to the Nomi and reply on Discord
+    mode = (env["nomi_mode"] or "standalone").lower()
+    if mode not in ("standalone", "gateway", "worker"):
+        os.sys.stderr.write(f"NOMI_MODE should be standalone, gateway or worker, not {mode}\n")
+        exit(1)
+
+    job_queue = None
+    if mode != "standalone":
+        if env["job_queue_url"] is None:
+            os.sys.stderr.write(f"JOB_QUEUE_URL was not found in the environment variables, but is needed to run as a {mode}\n")
+            exit(1)
+        try:
+            job_queue = JobQueue.from_url(env["job_queue_url"])
+        except ValueError as e:
+            os.sys.stderr.write(f"JOB_QUEUE_URL could not be used: {e}\n")
+            exit(1)
+
     message_modifiers = {
         "default_message_prefix" : env["default_message_prefix"],
         "default_message_suffix" : env["default_message_suffix"],
@@ -205,7 +227,8 @@ def main() -> None:
     nomi = NomiBot(nomi = nomi,
                    max_message_length = env["max_message_length"],
                    message_modifiers = message_modifiers,
-                   intents = intents
+                   intents = intents,
+                   job_queue = job_queue
                 )
 
     # Check if we're running on Render. We need to do
@@ -225,7 +248,10 @@ def main() -> None:
         heartbeat_handler_thread.start()
         heartbeat_thread.start()
 
-    nomi.run(token = env["discord_api_key"], root_logger = True)
+    if mode == "worker":
+        nomi.run_worker(token = env["discord_api_key"])
+    else:
+        nomi.run(token = env["discord_api_key"], root_logger = True)
 
 
 if __name__ == "__main__":
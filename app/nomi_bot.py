@@ -29,8 +29,9 @@
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 from __future__ import annotations
-from typing import Optional
+from typing import Any, Callable, Optional
 
+import asyncio
 import logging
 
 import discord
@@ -38,6 +39,9 @@ import regex
 from discord.ext import commands
 from nomi import Nomi
 
+from emoji_catalog import EmojiCatalog, unicode_emoji_phrase
+from job_queue import JobQueue
+
 # NomiBot Class. This is the main handler and includes
 # the majority of the custom message-handling logic
 class NomiBot(commands.Bot):
@@ -46,12 +50,15 @@ class NomiBot(commands.Bot):
     _default_message_suffix = "... (the message was cut off because it was too long)"
     _default_channel_message_prefix = "*You receive a message from {author} in {channel} on {guild} on Discord* "
     _default_dm_message_prefix = "*You receive a DM from {author} on Discord* "
-    _default_react_trigger_phrase = r"I.*?react.*?with.*?\p{Emoji}.*?"
+    _default_react_trigger_phrase = rf"I.*?react.*?with.*?(?:<a?:\w+:\d+>|:\w+:|{unicode_emoji_phrase}).*?"
 
     _default_max_message_length = 400
     _max_max_message_length = 600
 
-    def __init__(self, *, nomi: Nomi, max_message_length: Optional[int] = None, message_modifiers: dict[str, str], intents: discord.Intents, **options) -> None:
+    # Longest a worker will wait between polls while the job queue is failing
+    _max_poll_interval = 30
+
+    def __init__(self, *, nomi: Nomi, max_message_length: Optional[int] = None, message_modifiers: dict[str, str], intents: discord.Intents, job_queue: Optional[JobQueue] = None, **options) -> None:
         if type(nomi) is not Nomi:
             raise TypeError(f"Expected nomi to be a Nomi, got a {type(nomi).__name__}")
 
@@ -86,6 +93,16 @@ class NomiBot(commands.Bot):
             raise ValueError(f"max_message_length should be equal to or less than {self._max_max_message_length}")
         self.max_message_length = max_message_length
 
+        # Local record of the emojis we can react with, so we can
+        # skip reactions Discord would reject before we send them
+        self.emoji_catalog = EmojiCatalog()
+
+        # If we have a job queue we're running as part of a gateway
+        # and worker deployment, rather than doing everything ourselves
+        if job_queue is not None and not isinstance(job_queue, JobQueue):
+            raise TypeError(f"Expected job_queue to be a JobQueue, got a {type(job_queue).__name__}")
+        self.job_queue = job_queue
+
         super().__init__(command_prefix = "/", intents = intents, **options)
 
 
@@ -106,6 +123,155 @@ class NomiBot(commands.Bot):
         logging.info(f"{self.nomi.name} is now online. Happy chatting!")
 
 
+    def run_worker(self, token: str, poll_interval: float = 1) -> None:
+        # The worker equivalent of run(). Workers only use Discord's REST API,
+        # so we can start as many as we need without another gateway connection
+        if self.job_queue is None:
+            raise ValueError("A job_queue is needed to run as a worker")
+
+        discord.utils.setup_logging(root = True)
+        asyncio.run(self._start_worker(token, poll_interval))
+
+
+    async def _start_worker(self, token: str, poll_interval: float) -> None:
+        async with self:
+            await self.login(token)
+            logging.info(f"{self.nomi.name} worker is now online. Waiting for messages...")
+
+            # How long to wait before polling again. This grows while
+            # the queue is failing so we don't hammer it
+            delay = poll_interval
+
+            while True:
+                try:
+                    # The queue may block (e.g. waiting on a lock),
+                    # so keep it off the event loop
+                    job = await asyncio.to_thread(self.job_queue.get)
+                except Exception:
+                    logging.exception(f"Unable to get a job from the queue. Retrying in {delay} seconds")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self._max_poll_interval)
+                    continue
+
+                delay = poll_interval
+                if job is None:
+                    await asyncio.sleep(poll_interval)
+                    continue
+
+                job_id, job = job
+                try:
+                    await self._process_job(job)
+                except Exception:
+                    # Log and move on, the same way discord.py handles
+                    # an exception in on_message
+                    logging.exception(f"Failed to process job {job_id}")
+
+                try:
+                    await asyncio.to_thread(self.job_queue.ack, job_id)
+                except Exception:
+                    # The job will be handed out again once its claim times out
+                    logging.exception(f"Unable to acknowledge job {job_id}")
+
+
+    async def _process_job(self, job: dict) -> None:
+        # Everything we need to reply was sent along with the job,
+        # so the only calls to Discord are the reply itself
+        channel = self.get_partial_messageable(job["channel_id"],
+                                               guild_id = job["guild_id"],
+                                               type = discord.ChannelType(job["channel_type"])
+                                              )
+        discord_message = channel.get_partial_message(job["message_id"])
+
+        guild = None
+        if job["guild_id"] is not None:
+            guild = discord.Object(id = job["guild_id"])
+            self.emoji_catalog.set_guild_emojis(guild, [discord.PartialEmoji(**emoji) for emoji in job["emojis"]])
+
+        mentions = job["mentions"]
+        user_or_role_search = lambda name: (
+            discord.Object(id = mentions[name.lower()]) if name.lower() in mentions else None
+        )
+
+        # Pick up emojis other workers have found Discord rejects
+        rejected_emojis = await asyncio.to_thread(self.job_queue.get_rejected_emojis)
+        self.emoji_catalog.add_rejected_emojis(rejected_emojis)
+
+        # Set the typing indicator while we wait for the Nomi. The Nomi
+        # API blocks, so keep it off the event loop to keep typing going
+        async with channel.typing():
+            nomi_reply = await asyncio.to_thread(self._send_to_nomi, job["nomi_message"])
+
+        try:
+            async with channel.typing():
+                await self._deliver_reply(discord_message, channel, guild, nomi_reply, user_or_role_search)
+        finally:
+            # Share anything Discord rejected while we were replying
+            for emoji in self.emoji_catalog.get_rejected_emojis() - rejected_emojis:
+                await asyncio.to_thread(self.job_queue.reject_emoji, emoji)
+
+
+    def _make_job(self, discord_message, nomi_message: str) -> dict:
+        # Workers don't have our caches, so send along everything they
+        # need to reply. The Nomi can only know the names of the people
+        # in the conversation, so those are the only members we include.
+        # Unlike standalone mode, anyone else the Nomi @mentions stays as
+        # plain text; sending the whole member list would make every job
+        # as large as the guild
+        channel = discord_message.channel
+        guild = discord_message.guild
+
+        people = [discord_message.author, *discord_message.mentions]
+        people += [message.author for message in self.cached_messages if message.channel.id == channel.id]
+
+        mentions = {}
+        emojis = []
+        if guild:
+            for role in guild.roles:
+                mentions[role.name.lower()] = role.id
+
+            emojis = [{"id": emoji.id, "name": emoji.name, "animated": emoji.animated}
+                      for emoji in self.emoji_catalog.get_guild_emojis(guild)]
+
+        # Members take precedence over roles with the same name
+        for person in people:
+            mentions[person.display_name.lower()] = person.id
+            nick = getattr(person, "nick", None)
+            if nick:
+                mentions[nick.lower()] = person.id
+
+        return {
+            "message_id": discord_message.id,
+            "channel_id": channel.id,
+            "channel_type": channel.type.value,
+            "guild_id": guild.id if guild else None,
+            "nomi_message": nomi_message,
+            "mentions": mentions,
+            "emojis": emojis,
+        }
+
+
+    async def on_guild_available(self, guild):
+        self.emoji_catalog.update_guild(guild)
+
+
+    async def on_guild_join(self, guild):
+        self.emoji_catalog.update_guild(guild)
+
+
+    async def on_guild_remove(self, guild):
+        self.emoji_catalog.remove_guild(guild)
+
+
+    async def on_guild_emojis_update(self, guild, before, after):
+        self.emoji_catalog.update_guild(guild, after)
+
+
+    async def on_member_update(self, before, after):
+        # Our roles decide which role-restricted emojis we can use
+        if after.id == self.user.id and before.roles != after.roles:
+            self.emoji_catalog.update_guild(after.guild)
+
+
     async def on_message(self, discord_message):
 
         # We do not want the Nomi to reply to themselves
@@ -116,141 +282,163 @@ class NomiBot(commands.Bot):
 
         # Check if the Nomi is mentioned in the message, or if we're in DMs
         if self.user in discord_message.mentions or discord_message.guild is None:
-            # The Nomi was mentioned (or we're DMing). Now check to see if any other
-            # users or roles were mentioned, and convert their mention_id to their
-            # username or display name prefixed with an @ symbol
-            discord_message_content = discord_message.content
-
-            for user in discord_message.mentions:
-                name = user.nick if user.nick else user.display_name
-                # Mentions are formatted differently if a user has set a nickname
-                if user.nick:
-                    mention_id = f"<@!{user.id}>"
-                else:
-                    mention_id = f"<@{user.id}>"
-
-                # Replace the mention with the user's name
-                discord_message_content = discord_message_content.replace(mention_id, f"@{name}")
+            nomi_message = self._build_nomi_message(discord_message)
 
-            for role in discord_message.role_mentions:
-                role = role.name
-                mention_id = f"<@&{role.id}>"
-
-                # Replace the mention with the role's name
-                discord_message_content = discord_message_content.replace(mention_id, f"@{role}")
+            # If we're running as a gateway, hand the message off to
+            # a worker to talk to the Nomi and reply on Discord
+            if self.job_queue is not None:
+                job = self._make_job(discord_message, nomi_message)
+                # The queue may block, and we mustn't hold up the gateway heartbeat
+                await asyncio.to_thread(self.job_queue.put, job)
+                return
 
             # Set the typing indicator. The Nomi is 'typing' the whole time
             # we are communicating with them, which includes sending the message
             # to the Nomi API, waiting for their response, and sending it back
             # to Discord
             async with discord_message.channel.typing():
-                # Build the message to send to the Nomi
-                author = discord_message.author
-                message_prefix = self.default_message_prefix
-
-                # In DMs channel and guild are None
-                if isinstance(discord_message.channel, discord.DMChannel):
-                    channel = None
-                    guild = None
-                    message_prefix = self.dm_message_prefix
-                else:
-                    channel = discord_message.channel
-                    guild = discord_message.guild
-                    message_prefix = self.channel_message_prefix
-
-                nomi_message = message_prefix.format(author = author,
-                                                     channel = channel,
-                                                     guild = guild
-                                                    )
-
-                nomi_message = nomi_message + discord_message_content
-                nomi_message = self._trim_message(nomi_message)
-
-                try:
-                    # Attempt to send message
-                    _, reply = self.nomi.send_message(nomi_message)
-                    nomi_reply = reply.text
-                except RuntimeError as e:
-                    # If there's an error, use that as the reply so we can let
-                    # the user know what went wrong
-                    nomi_reply  = f"{self.nomi.name} encountered an error when trying to reply: {str(e)}"
+                nomi_reply = self._send_to_nomi(nomi_message)
 
             # Re-set the typing indicator. The Nomi is 'typing' the whole time
             # we are communicating with them, which includes sending the message
             # to the Nomi API, waiting for their response, and sending it back
             # to Discord
             async with discord_message.channel.typing():
-                # Attempt to substitute user or role ID in any mentions
-                # Example: replace the <@userid>, <!@userid> or <@&roleid> with the name
-                #          of the user, the user's nickname or name of the role
-                # Use a regular expression to find words that start with @
-                matches = regex.findall(r"@&?(\w+)", nomi_reply)
-
-                if matches:
-                    # Determine if the message is in a DM or a guild
-                    if discord_message.guild:
-                        # If it's a guild, use the guild's member list and role list
-                        # TODO: Can this be made more efficient with just user.display_name?
-                        user_or_role_search = lambda name: (
-                            discord.utils.find(
-                                lambda m: m.display_name.lower() == name.lower() or (m.nick and m.nick.lower() == name.lower()),
-                                discord_message.guild.members
-                            ) or discord.utils.find(
-                                lambda r: r.name.lower() == name.lower(),
-                                discord_message.guild.roles
-                            )
+                # Determine if the message is in a DM or a guild
+                if discord_message.guild:
+                    # If it's a guild, use the guild's member list and role list
+                    # TODO: Can this be made more efficient with just user.display_name?
+                    user_or_role_search = lambda name: (
+                        discord.utils.find(
+                            lambda m: m.display_name.lower() == name.lower() or (m.nick and m.nick.lower() == name.lower()),
+                            discord_message.guild.members
+                        ) or discord.utils.find(
+                            lambda r: r.name.lower() == name.lower(),
+                            discord_message.guild.roles
                         )
+                    )
+                else:
+                    # If it's a DM, use the Nomi's user cache (roles don't apply in DMs)
+                    user_or_role_search = lambda name: discord.utils.find(
+                        lambda u: u.display_name.lower() == name.lower(),
+                        self.users
+                    )
+
+                await self._deliver_reply(discord_message, discord_message.channel, discord_message.guild, nomi_reply, user_or_role_search)
+
+
+    def _build_nomi_message(self, discord_message) -> str:
+        # The Nomi was mentioned (or we're DMing). Now check to see if any other
+        # users or roles were mentioned, and convert their mention_id to their
+        # username or display name prefixed with an @ symbol
+        discord_message_content = discord_message.content
+
+        for user in discord_message.mentions:
+            name = user.nick if user.nick else user.display_name
+            # Mentions are formatted differently if a user has set a nickname
+            if user.nick:
+                mention_id = f"<@!{user.id}>"
+            else:
+                mention_id = f"<@{user.id}>"
+
+            # Replace the mention with the user's name
+            discord_message_content = discord_message_content.replace(mention_id, f"@{name}")
+
+        for role in discord_message.role_mentions:
+            role = role.name
+            mention_id = f"<@&{role.id}>"
+
+            # Replace the mention with the role's name
+            discord_message_content = discord_message_content.replace(mention_id, f"@{role}")
+
+        # Build the message to send to the Nomi
+        author = discord_message.author
+        message_prefix = self.default_message_prefix
+
+        # In DMs channel and guild are None
+        if isinstance(discord_message.channel, discord.DMChannel):
+            channel = None
+            guild = None
+            message_prefix = self.dm_message_prefix
+        else:
+            channel = discord_message.channel
+            guild = discord_message.guild
+            message_prefix = self.channel_message_prefix
+
+        nomi_message = message_prefix.format(author = author,
+                                             channel = channel,
+                                             guild = guild
+                                            )
+
+        nomi_message = nomi_message + discord_message_content
+        return self._trim_message(nomi_message)
+
+
+    def _send_to_nomi(self, nomi_message: str) -> str:
+        try:
+            # Attempt to send message
+            _, reply = self.nomi.send_message(nomi_message)
+            return reply.text
+        except RuntimeError as e:
+            # If there's an error, use that as the reply so we can let
+            # the user know what went wrong
+            return f"{self.nomi.name} encountered an error when trying to reply: {str(e)}"
+
+
+    async def _deliver_reply(self, discord_message, channel, guild, nomi_reply: str, user_or_role_search: Callable[[str], Any]) -> None:
+        # discord_message may be a PartialMessage when we're running as a worker,
+        # so everything else we need to know about it is passed in separately.
+        # user_or_role_search takes a name and returns something with an id,
+        # or None if nobody by that name can be found
+
+        # Attempt to substitute user or role ID in any mentions
+        # Example: replace the <@userid>, <!@userid> or <@&roleid> with the name
+        #          of the user, the user's nickname or name of the role
+        # Use a regular expression to find words that start with @
+        matches = regex.findall(r"@&?(\w+)", nomi_reply)
+
+        if matches:
+            for match in matches:
+                user = user_or_role_search(match)
+                if user:
+                    mention = f"<@{user.id}>"
+                    # Replace @username or @role with the proper mention
+                    nomi_reply = nomi_reply.replace(f"@{match}", mention)
+
+        logging.info(f"Sending message to Discord from {self.nomi.name}: {nomi_reply}")
+
+        # If the nomi has reacted to the message using the react
+        # key phrase, attempt to get that from the Nomi's message
+        # and react to our message accordingly
+        # Search for the pattern in the text
+        matches = regex.findall(self.react_trigger_pattern, nomi_reply)
+
+        # Extract the matched phrase and emoji if found
+        for match in matches:
+
+            # Look for emojis we know Discord will accept
+            emojis = self.emoji_catalog.find_reactions(match, guild)
+            for emoji in emojis:
+                try:
+                    # Attempt to send to Discord
+                    await discord_message.add_reaction(emoji)
+                except discord.errors.HTTPException as e:
+                    # Check for a specific error code: 10014 (Unknown Emoji)
+                    if e.status == 400 and e.code == 10014:
+                        logging.error(f"Failed to add reaction: {emoji} is an unknown emoji")
+                        # Remember this so we never try it again
+                        self.emoji_catalog.reject(emoji)
                     else:
-                        # If it's a DM, use the Nomi's user cache (roles don't apply in DMs)
-                        user_or_role_search = lambda name: discord.utils.find(
-                            lambda u: u.display_name.lower() == name.lower(),
-                            self.users
-                        )
-
-                    for match in matches:
-                        user = user_or_role_search(match)
-                        if user:
-                            mention = f"<@{user.id}>"
-                            # Replace @username or @role with the proper mention
-                            nomi_reply = nomi_reply.replace(f"@{match}", mention)
-
-                logging.info(f"Sending message to Discord from {self.nomi.name}: {nomi_reply}")
-
-                # If the nomi has reacted to the message using the react
-                # key phrase, attempt to get that from the Nomi's message
-                # and react to our message accordingly
-                # Search for the pattern in the text
-                matches = regex.findall(self.react_trigger_pattern, nomi_reply)
-
-                # Extract the matched phrase and emoji if found
-                for match in matches:
-
-                    # Look for emojis
-                    emojis = regex.findall(r"\p{Emoji}", match)
-                    for emoji in emojis:
-                        # The regex matches * as an emoji
-                        if emoji == "*":
-                            continue
-                        try:
-                            # Attempt to send to Discord
-                            await discord_message.add_reaction(emoji)
-                        except discord.errors.HTTPException as e:
-                            # Check for a specific error code: 10014 (Unknown Emoji)
-                            if e.status == 400 and e.code == 10014:
-                                logging.error(f"Failed to add reaction: {emoji} is an unknown emoji")
-                                # TODO: Figure out a better way to handle a failed react
-                                pass
-                            else:
-                                # Re-raise if it's a different HTTPException
-                                raise
-                    # Remove the Nomi's react from the text of their reply
-                    nomi_reply = regex.sub(match, '', nomi_reply)
-
-                # Clean up the reply message
-                nomi_reply = nomi_reply.replace("**", '')
-                nomi_reply.strip()
-
-                # If there's more text, send that as a reply. Don't reply
-                # if the Nomi just send at reaction
-                if nomi_reply:
-                    await discord_message.channel.send(nomi_reply)
+                        # Re-raise if it's a different HTTPException
+                        raise
+            # Remove the Nomi's react from the text of their reply
+            nomi_reply = nomi_reply.replace(match, '')
+
+        # Clean up the reply message
+        nomi_reply = nomi_reply.replace("**", '')
+        nomi_reply.strip()
+
+        # If there's more text, send that as a reply. Don't reply
+        # if the Nomi just send at reaction
+        if nomi_reply:
+            await channel.send(nomi_reply)